@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import collections
 import enum
 import json
 import logging
@@ -9,6 +10,8 @@ import strink
 
 __version__ = "1.0.2"
 
+ReplayGain = collections.namedtuple("ReplayGain", ("file", "loudness", "range", "true_peak", "true_peak_dBTP", "reference", "will_clip", "clip_prevent", "gain", "new_peak", "new_peak_dBTP"))
+
 class UpperDict(dict):
 	class _Sentinel(enum.Enum):
 		NOTSPECIFIED = 1
@@ -142,6 +145,17 @@ class Probe:
 		# if new.format_name.startswith("image"):
 		#	new.tags["format_is_image"] = True
 		return new
+
+	def clone(self, path):
+		"""Copy of this probe for an identical file at path, without probing it again"""
+		new = type(self)()
+		new.__dict__.update(self.__dict__)
+		new.tags = UpperDict(self.tags)
+		new.stream_tags = set(self.stream_tags)
+		new.stream_codecs = dict(self.stream_codecs)
+		new.path = pathlib.Path(path)
+		new.filename = str(path)
+		return new
 	
 	def streams(self):
 		return {s["index"]: s for s in self._stream_data if not s.get("disposition", {}).get("attached_pic", False)}
@@ -150,24 +164,9 @@ class Probe:
 		sts = self.streams()
 		return len(sts) and all(map(lambda s: s["codec_type"] == "video" and s["nb_read_frames"] == "1", sts.values()))
 	
-	def writeMeta(self, newTags, /, newPath=None, codec={}, dryRun=False):
-		import tempfile
-
-		def meta_args():
-			for k, v in newTags.items():
-				met = "%s=%s" % (k, "" if v is None else v)
-				if k in self.stream_tags:
-					# Make sure ffmpeg overwrites existing tags
-					yield f"-metadata:s:m:{k}"
-					yield met
-				else:
-					yield f"-metadata"
-					yield met
-
-		def codec_args(codec_map):
-			for k, v in filter(lambda kv: kv[0] is not None, codec_map):
-				yield f"{k}"
-				yield str(v)
+	def planMeta(self, newTags, /, newPath=None, codec={}, remove=False):
+		"""Decide what has to happen to this file, without doing it
+		Returns an operation dict (see execute()), or None if there is nothing to do"""
 
 		def stream_codec_map():
 			codec_name_map = {}
@@ -187,56 +186,190 @@ class Probe:
 
 			if None in codec_type_map:
 				yield (f"-codec", codec_type_map[None])
+			elif not codec:
+				# Not transcoding, so only change the tags
+				yield (f"-codec", "copy")
 			else:
 				yield (None, None)
 
 			for index, stream in self.stream_codecs.items():
 				ctype, cname = stream
 				if cname.casefold() in codec_name_map:
-					#yield "-%s:%d" % (codec_name_map[stream.casefold()][0], index)
-					#yield "copy"
 					yield ("-%s:%d" % (codec_name_map[cname.casefold()][0], index), "copy")
 				elif ctype[0] in codec_type_map:
 					yield ("-codec:%s:%d" % (ctype[0], index), codec_type_map[ctype[0]])
 				elif None in codec_type_map and cname.casefold() in codec_name_map:
 					yield ("-codec:{index}", "copy")
 
-		log = logging.getLogger("Probe.writeMeta")
 		newTags = UpperDict(newTags)
-		
+		newPath = self.path if newPath is None else pathlib.Path(newPath)
 		codec_map = [(k, v) for k, v in stream_codec_map()]
 
-		tmp = None
 		if not newTags and all(map(lambda v:v[1]=="copy", codec_map[1:])):
-			if not newPath or (newPath.exists() and self.path.samefile(newPath)):
-				return (None, None)
+			if newPath.exists() and self.path.samefile(newPath):
+				return None
+			action = "replace"
+		elif newPath.exists() and self.path.samefile(newPath):
+			# ffmpeg can't write in place, so go via a temporary file
+			action = "tmpcode"
+		else:
+			action = "transcode"
+
+		return {
+			"source": str(self.path),
+			"target": str(newPath),
+			"action": action,
+			"tags": {k: ("" if v is None else str(v)) for k, v in newTags.items()},
+			# Make sure ffmpeg overwrites existing tags
+			"stream_tags": sorted(k for k in newTags.keys() if k in self.stream_tags),
+			"codec": [[k, str(v)] for k, v in codec_map if k is not None],
+			"remove": bool(remove),
+		}
+
+def execute(op, /, dryRun=False):
+	"""Carry out a single operation made by Probe.planMeta()
+	op["action"] is one of:
+		"replace"   -- copy (or move, if op["remove"]) the file as-is
+		"link"      -- reflink or hardlink op["link_from"] to target, which is an identical file written by another operation
+		"transcode" -- run ffmpeg from source to target
+		"tmpcode"   -- run ffmpeg to a temporary file, then replace the source with it"""
+	import shutil
+	import subprocess
+	import tempfile
+
+	def meta_args():
+		for k, v in op["tags"].items():
+			if k in op["stream_tags"]:
+				yield f"-metadata:s:m:{k}"
 			else:
-				if not dryRun:
-					newPath.parent.exists() or log.debug(f"mkdir {npath.parent!a}")
-					newPath.parent.mkdir(parents=True, exist_ok=True)
-				return (self.path, "replace")
-					# self.path.replace(newPath)
-		elif not dryRun:
-			newPath = pathlib.Path(newPath)
-			if not newPath or (newPath.exists() and self.path.samefile(newPath)):
-				tmp = tempfile.NamedTemporaryFile(prefix="bemuse_", delete=False, suffix=newPath.suffix) ; tmp.close()
-				newPath = pathlib.Path(tmp.name)
+				yield f"-metadata"
+			yield f"{k}={v}"
+
+	log = logging.getLogger("execute")
+	source, target = pathlib.Path(op["source"]), pathlib.Path(op["target"])
+
+	if op["action"] == "replace":
+		log.debug(["mv" if op["remove"] else "cp", str(source), str(target)])
+		if not dryRun:
+			target.parent.exists() or log.debug(f"mkdir {str(target.parent)!a}")
+			target.parent.mkdir(parents=True, exist_ok=True)
+			if op["remove"]:
+				source.replace(target)
 			else:
-				newPath.parent.mkdir(parents=True, exist_ok=True)
+				target.write_bytes(source.read_bytes())
+		return
+	elif op["action"] == "link":
+		log.debug(["ln", op["link_from"], str(target)])
+		if not dryRun:
+			target.parent.mkdir(parents=True, exist_ok=True)
+			link_file(pathlib.Path(op["link_from"]), target)
+			if op["remove"]:
+				log.debug(["rm", str(source)])
+				source.unlink()
+		return
 
-		ffargs = ["ffmpeg", "-i", self.filename, *meta_args(), *codec_args(codec_map), "-loglevel", "0", "-y", "-nostdin", str(newPath)]
-		if dryRun:
-			print(ffargs)
-		else:
-			log.debug(str(ffargs))
-			ran = subprocess.run(ffargs, check=True)
+	output = target
+	if dryRun:
+		pass
+	elif op["action"] == "tmpcode":
+		tmp = tempfile.NamedTemporaryFile(prefix="bemuse_", delete=False, suffix=target.suffix) ; tmp.close()
+		output = pathlib.Path(tmp.name)
+	else:
+		target.parent.mkdir(parents=True, exist_ok=True)
 
-		if tmp:
-			return (newPath, "tmpcode")
-		else:
-			return (newPath, "transcode")
+	ffargs = ["ffmpeg", "-i", str(source), *meta_args(), *(a for kv in op["codec"] for a in kv), "-loglevel", "0", "-y", "-nostdin", str(output)]
+	if dryRun:
+		print(ffargs)
+		return
 
-def replaygain(tracklist):
+	log.debug(str(ffargs))
+	try:
+		subprocess.run(ffargs, check=True)
+	except subprocess.CalledProcessError:
+		if output != target:
+			output.unlink(missing_ok=True)
+		raise
+
+	if op["action"] == "tmpcode":
+		log.debug(["mv", str(output), str(target)])
+		shutil.move(output, target)
+	elif op["remove"]:
+		log.debug(["rm", str(source)])
+		source.unlink()
+
+def execute_plan(ops, /, jobs=1, dryRun=False, done=None):
+	"""Execute a list of operations
+	Duplicate operations are only run once, and operations that write to the same target from different sources are skipped.
+	If one operation's target is another operation's source, the latter is run first.
+	"link" operations are run after the operation that writes the file they link to, and fail if that one failed or was skipped.
+	done(op) is called for each operation that succeeds.
+	Returns the number of operations that failed"""
+	import collections
+	import concurrent.futures
+	import os
+	import subprocess
+
+	log = logging.getLogger("execute_plan")
+
+	unique = {}
+	for op in ops:
+		unique.setdefault(json.dumps(op, sort_keys=True), op)
+	pending = list(unique.values())
+
+	bytarget = {}
+	for op in pending:
+		bytarget.setdefault(os.path.abspath(op["target"]), []).append(op)
+	failed = 0
+	# Targets that were not written, so nothing may be linked to them
+	unwritten = set()
+	for target, colliding in bytarget.items():
+		if len(colliding) > 1:
+			log.error(f"skipping {len(colliding)} files with the same destination {target!r}: " + ", ".join(repr(op["source"]) for op in colliding))
+			failed += len(colliding)
+			unwritten.add(target)
+			for op in colliding:
+				pending.remove(op)
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+		while pending:
+			sources = collections.Counter(os.path.abspath(op["source"]) for op in pending)
+			targets = {os.path.abspath(op["target"]) for op in pending}
+			ready = []
+			for op in pending:
+				target = os.path.abspath(op["target"])
+				# An operation in place (tmpcode) only waits for others reading the same file
+				if sources[target] - (target == os.path.abspath(op["source"])):
+					continue
+				if op["action"] == "link" and os.path.abspath(op["link_from"]) in targets:
+					continue
+				ready.append(op)
+			if not ready:
+				log.error("skipping operations with circular destinations: " + ", ".join(repr(op["source"]) for op in pending))
+				failed += len(pending)
+				break
+			pending = [op for op in pending if op not in ready]
+			for op in [op for op in ready if op["action"] == "link" and os.path.abspath(op["link_from"]) in unwritten]:
+				log.error(f"skipping {op['target']!r}: {op['link_from']!r} was not written")
+				failed += 1
+				unwritten.add(os.path.abspath(op["target"]))
+				ready.remove(op)
+			ready.sort(key=lambda op: op["target"])
+
+			futures = {pool.submit(execute, op, dryRun=dryRun): op for op in ready}
+			for fut in concurrent.futures.as_completed(futures):
+				try:
+					fut.result()
+				except (OSError, subprocess.SubprocessError) as err:
+					log.error(f"could not write {futures[fut]['target']!r} :: {type(err).__name__} {str(err)}")
+					failed += 1
+					unwritten.add(os.path.abspath(futures[fut]["target"]))
+				else:
+					done and not dryRun and done(futures[fut])
+	return failed
+
+def replaygain(tracklist, /, album=True):
+	"""Run loudgain over tracklist, yielding (track, fields) for each track
+	If album is True, then finally yield (None, fields) for the whole album"""
 	import collections
 	import subprocess
 	import re
@@ -244,7 +377,7 @@ def replaygain(tracklist):
 	files = tuple(tracklist)
 
 	if files:
-		loudgainargs = ["loudgain", "-a", "-O", *(t.filename for t in files)]
+		loudgainargs = ["loudgain", *(["-a"] if album else []), "-O", *(t.filename for t in files)]
 		ran = subprocess.run(loudgainargs, capture_output=True, text=True)
 
 		if ran.returncode:
@@ -256,15 +389,414 @@ def replaygain(tracklist):
 			# de-capitalise the first character of the field names
 			Fields = collections.namedtuple("ReplayGain", ( ("".join(t.lower() if i % 2 else t for i, t in enumerate(v)) for v in (re.split("(?<![A-Za-z])([A-Z])", field) for field in lines[0].strip().split("\t")) ) )  )
 			# Skip header and album line
-			for track, line in zip(files, lines[1:-1]):
+			for track, line in zip(files, lines[1:-1] if album else lines[1:]):
 				yield (track, Fields(*line.strip().split("\t")))
 			# Yield album line with filename = None
-			yield (None, Fields(None, *lines[-1].strip().split("\t")[1:]))
+			if album:
+				yield (None, Fields(None, *lines[-1].strip().split("\t")[1:]))
+
+def replaygain_batches(tracklist, /, size=256):
+	"""Split tracklist into tuples of at most size tracks, that each fit on a loudgain command line"""
+	import os
+	try:
+		argmax = os.sysconf("SC_ARG_MAX") // 2   # leave room for the environment
+	except (ValueError, OSError):
+		argmax = 32768
+	batch = []
+	length = 0
+	for t in tracklist:
+		arglen = len(os.fsencode(t.filename)) + 1
+		if batch and (len(batch) >= size or length + arglen > argmax):
+			yield tuple(batch)
+			batch = []
+			length = 0
+		batch.append(t)
+		length += arglen
+	if batch:
+		yield tuple(batch)
+
+def album_key(probe, keys):
+	"""The album group a probe belongs to: a tuple of the values of the tags in keys, or None if it has no album tag
+	The pseudo-tag "dirname" is the directory containing the file"""
+	if "album" not in probe.tags:
+		return None
+	return tuple(str(probe.path.parent) if k.casefold() == "dirname" else probe.tags.get(k, None) for k in keys)
+
+class LoudnessStore:
+	"""Per-track loudness data, kept in a JSON file between runs so album gain can be recalculated without analysing every track again
+	self.entries : {absolute path: {
+		"stat"      : [size, mtime_ns] -- the entry is only valid while these are unchanged
+		"momentary" : {decilufs: count} -- histogram of 400ms gating block loudness (ITU-R BS.1770)
+		"shortterm" : {decilufs: count} -- histogram of 3s short-term loudness (EBU Tech 3342)
+		"peak"      : linear true peak
+	}}"""
+	REFERENCE = -18.0  # LUFS, same as loudgain
+
+	def __init__(self, path):
+		self.path = pathlib.Path(path)
+		self.entries = {}
+		self.changed = set()
+		if self.path.exists():
+			with self.path.open() as fd:
+				self.entries = json.load(fd)
+
+	@staticmethod
+	def fingerprint(path):
+		st = pathlib.Path(path).stat()
+		return [st.st_size, st.st_mtime_ns]
+
+	def get(self, path):
+		import os
+		entry = self.entries.get(os.path.abspath(path), None)
+		if entry is not None and entry["stat"] == self.fingerprint(path):
+			return entry
+		return None
+
+	def analyse(self, path):
+		"""Measure the first audio stream of path with ffmpeg's ebur128 filter, and store the result"""
+		import collections
+		import os
+		import re
+		import subprocess
+
+		stat = self.fingerprint(path)
+		ran = subprocess.run(["ffmpeg", "-nostdin", "-hide_banner", "-nostats", "-i", str(path), "-map", "0:a:0", "-af", "ebur128=peak=true", "-f", "null", "-"],
+			capture_output=True, text=True, check=True)
+		momentary = collections.Counter()
+		shortterm = collections.Counter()
+		peak = 0.0
+		for line in ran.stderr.splitlines():
+			frame = re.search(r"\bM:\s*(-?[\d.]+)\s+S:\s*(-?[\d.]+)", line)
+			if frame:
+				# Anything below the absolute gate is never used
+				for hist, val in zip((momentary, shortterm), map(float, frame.groups())):
+					if val > -70.0:
+						hist[str(round(val * 10))] += 1
+				continue
+			summary = re.match(r"\s*Peak:\s*(-?[\d.]+|-inf)\s*dBFS", line)
+			if summary and summary[1] != "-inf":
+				peak = 10 ** (float(summary[1]) / 20)
+
+		key = os.path.abspath(path)
+		self.entries[key] = {"stat": stat, "momentary": dict(momentary), "shortterm": dict(shortterm), "peak": peak}
+		self.changed.add(key)
+		return self.entries[key]
+
+	def moved(self, op):
+		"""Keep the entry for a file that an operation has copied, moved or re-tagged without re-encoding the audio"""
+		import os
+		source, target = os.path.abspath(op["source"]), os.path.abspath(op["target"])
+		entry = self.entries.get(source, None)
+		if entry is None or op["action"] in ("transcode", "tmpcode") and not all(v == "copy" for _, v in op["codec"]):
+			return
+		self.entries[target] = dict(entry, stat=self.fingerprint(target))
+		self.changed.add(target)
+		if op["remove"] and source != target:
+			self.entries.pop(source)
+			self.changed.add(source)
+
+	def save(self):
+		"""Write changed entries, merging with whatever other processes have saved since we loaded the file
+		The read-merge-write is done under an exclusive lock on a .lock file next to it, so concurrent saves don't lose entries"""
+		import fcntl
+		import os
+		self.path.parent.mkdir(parents=True, exist_ok=True)
+		with self.path.with_name(self.path.name + ".lock").open("a") as lock:
+			fcntl.flock(lock, fcntl.LOCK_EX)
+			entries = {}
+			if self.path.exists():
+				with self.path.open() as fd:
+					entries = json.load(fd)
+			for key in self.changed:
+				if key in self.entries:
+					entries[key] = self.entries[key]
+				else:
+					entries.pop(key, None)
+			tmp = self.path.with_name(f".{self.path.name}.{os.getpid()}")
+			with tmp.open("w") as fd:
+				json.dump(entries, fd)
+			tmp.replace(self.path)
+		self.changed.clear()
+
+	@staticmethod
+	def mean(hist, gate):
+		"""Mean loudness of the blocks of a histogram above gate, in LUFS (None if there are none)"""
+		import math
+		energy = count = 0
+		for k, n in hist.items():
+			lufs = int(k) / 10
+			if lufs > gate:
+				energy += n * 10 ** ((lufs + 0.691) / 10)
+				count += n
+		return -0.691 + 10 * math.log10(energy / count) if count else None
+
+	@classmethod
+	def relative_gate(cls, hist, relative):
+		"""Relative gate threshold of a histogram: the mean loudness of the blocks above the absolute gate (-70 LUFS), plus relative LU
+		Returns None if there are no blocks above the absolute gate"""
+		ungated = cls.mean(hist, -70.0)
+		return None if ungated is None else ungated + relative
+
+	@classmethod
+	def integrated(cls, hist):
+		"""Gated loudness (ITU-R BS.1770) of a momentary block histogram, in LUFS (None if there are no blocks above the absolute gate)"""
+		gate = cls.relative_gate(hist, -10.0)
+		return None if gate is None else cls.mean(hist, max(gate, -70.0))
+
+	@classmethod
+	def loudness_range(cls, hist):
+		"""Loudness range (EBU Tech 3342) of a short-term histogram, in LU
+
+		EBU Tech 3342 test signals 1-4, ignoring the short-term values that straddle the level changes:
+		>>> LoudnessStore.loudness_range({"-200": 200, "-300": 200})
+		10.0
+		>>> LoudnessStore.loudness_range({"-200": 200, "-150": 200})
+		5.0
+		>>> LoudnessStore.loudness_range({"-400": 200, "-200": 200})
+		20.0
+		>>> LoudnessStore.loudness_range({"-500": 400, "-350": 400, "-200": 200})
+		15.0
+		>>> round(LoudnessStore.loudness_range({str(k): 1 for k in range(-300, -99)}), 1)
+		17.0
+		"""
+		gate = cls.relative_gate(hist, -20.0)
+		if gate is None:
+			return 0.0
+		gated = sorted((int(k) / 10, n) for k, n in hist.items() if int(k) / 10 > max(gate, -70.0))
+		total = sum(n for _, n in gated)
+
+		def percentile(p):
+			seen = 0
+			for lufs, n in gated:
+				seen += n
+				if seen >= p * total:
+					return lufs
+		return percentile(0.95) - percentile(0.10)
+
+	@classmethod
+	def fields(cls, filename, momentary, shortterm, peak):
+		"""Format a measurement like a line of loudgain -O output"""
+		import math
+		loudness = cls.integrated(momentary)
+		if loudness is None:
+			loudness = -70.0
+		gain = cls.REFERENCE - loudness
+		new_peak = peak * 10 ** (gain / 20)
+
+		def dbtp(p):
+			return "%.2f dBTP" % (20 * math.log10(p) if p > 0 else -math.inf)
+
+		return ReplayGain(filename, "%.2f LUFS" % loudness, "%.2f LU" % cls.loudness_range(shortterm), "%.6f" % peak, dbtp(peak),
+			"%.2f LUFS" % cls.REFERENCE, "Y" if new_peak > 1.0 else "N", "N", "%.2f dB" % gain, "%.6f" % new_peak, dbtp(new_peak))
+
+def replaygain_stored(tracklist, store, /, jobs=1):
+	"""Like replaygain(), but uses (and updates) per-track loudness data in store, so only new or changed tracks are analysed
+	Tracks that ffmpeg fails to analyse are logged and left out, as is the album gain then"""
+	import collections
+	import concurrent.futures
+	import subprocess
+
+	log = logging.getLogger("replaygain_stored")
+	files = tuple(tracklist)
+	if not files:
+		return
+
+	def analyse(t):
+		try:
+			return store.analyse(t.path)
+		except subprocess.CalledProcessError as err:
+			reason = err.stderr.rstrip().rsplit("\n", 1)[-1]
+			log.error(f"Could not analyse {t.filename!r}: {reason}")
+			return None
+
+	entries = {t: store.get(t.path) for t in files}
+	todo = [t for t, e in entries.items() if e is None]
+	log.info(f"{len(files) - len(todo)} tracks cached, {len(todo)} to analyse")
+	with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+		for t, entry in zip(todo, pool.map(analyse, todo)):
+			entries[t] = entry
+
+	failed = [t for t in files if entries[t] is None]
+	if failed:
+		# Album gain without some of the tracks would be wrong, so only track gain for the rest
+		log.warning(f"{len(failed)} tracks could not be analysed, skipping album gain")
+		files = tuple(t for t in files if entries[t] is not None)
+
+	momentary = collections.Counter()
+	shortterm = collections.Counter()
+	for t in files:
+		e = entries[t]
+		momentary.update(e["momentary"])
+		shortterm.update(e["shortterm"])
+		yield (t, store.fields(t.filename, e["momentary"], e["shortterm"], e["peak"]))
+	if not failed:
+		yield (None, store.fields(None, momentary, shortterm, max(entries[t]["peak"] for t in files)))
+
+class Inotify:
+	"""Watch directory trees for files that have finished being written, using Linux inotify (through ctypes)
+	self.writing : set of files that have been created or written to, but not closed yet"""
+	IN_MODIFY      = 0x00000002
+	IN_CLOSE_WRITE = 0x00000008
+	IN_MOVED_FROM  = 0x00000040
+	IN_MOVED_TO    = 0x00000080
+	IN_CREATE      = 0x00000100
+	IN_DELETE      = 0x00000200
+	IN_Q_OVERFLOW  = 0x00004000
+	IN_IGNORED     = 0x00008000
+	IN_ISDIR       = 0x40000000
+
+	def __init__(self):
+		import ctypes
+		import ctypes.util
+		import os
+		self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+		self.fd = self._libc.inotify_init1(os.O_CLOEXEC)
+		if self.fd < 0:
+			err = ctypes.get_errno()
+			raise OSError(err, os.strerror(err))
+		self.watches = {}
+		self.writing = set()
+
+	def add(self, path):
+		"""Watch path and every directory below it"""
+		import ctypes
+		import errno
+		import os
+		for d, _, _ in os.walk(path):
+			wd = self._libc.inotify_add_watch(self.fd, os.fsencode(d), self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE)
+			if wd < 0:
+				err = ctypes.get_errno()
+				if err == errno.ENOENT:
+					continue
+				raise OSError(err, os.strerror(err), d)
+			self.watches[wd] = pathlib.Path(d)
+
+	def read(self, timeout=None):
+		"""Wait up to timeout seconds (forever if None) for changes, and return the set of paths created, written or moved in
+		New directories are watched, and returned as a whole, as files may have been moved in with them
+		Files that are still being written are kept in self.writing until they are closed, deleted or moved away"""
+		import os
+		import select
+		import stat
+		import struct
+
+		changed = set()
+		if not select.select([self.fd], [], [], timeout)[0]:
+			return changed
+		buf = os.read(self.fd, 65536)
+		pos = 0
+		while pos < len(buf):
+			wd, mask, cookie, length = struct.unpack_from("iIII", buf, pos)
+			name = os.fsdecode(buf[pos + 16:pos + 16 + length].rstrip(b"\0"))
+			pos += 16 + length
+			if mask & self.IN_Q_OVERFLOW:
+				# Events were lost, so anything could have changed
+				changed.update(self.watches.values())
+			elif mask & self.IN_IGNORED:
+				self.watches.pop(wd, None)
+			elif wd in self.watches:
+				path = self.watches[wd] / name
+				if mask & self.IN_ISDIR:
+					self.add(path)
+					changed.add(path)
+				elif mask & (self.IN_CLOSE_WRITE | self.IN_DELETE | self.IN_MOVED_FROM):
+					self.writing.discard(path)
+					changed.add(path)
+				elif mask & self.IN_MOVED_TO:
+					changed.add(path)
+				elif mask & self.IN_MODIFY:
+					self.writing.add(path)
+					changed.add(path)
+				elif mask & self.IN_CREATE:
+					# Hard links and symlinks are created without being opened, so they never get closed
+					try:
+						st = os.lstat(path)
+					except FileNotFoundError:
+						continue
+					if stat.S_ISREG(st.st_mode) and st.st_nlink == 1:
+						self.writing.add(path)
+					changed.add(path)
+		return changed
+
+	def close(self):
+		import os
+		os.close(self.fd)
+
+def link_file(src, dst):
+	"""Make dst share src's data: a reflink if the filesystem supports it, otherwise a hardlink, otherwise a copy"""
+	import errno
+	import fcntl
+	import os
+	import shutil
+
+	FICLONE = 0x40049409
+
+	dst.unlink(missing_ok=True)
+	try:
+		with src.open("rb") as sfd, dst.open("wb") as dfd:
+			fcntl.ioctl(dfd.fileno(), FICLONE, sfd.fileno())
+		return
+	except OSError as err:
+		dst.unlink(missing_ok=True)
+		if err.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.EBADF):
+			raise
+	try:
+		os.link(src, dst)
+	except OSError as err:
+		if err.errno not in (errno.EPERM, errno.EXDEV, errno.EMLINK, errno.EOPNOTSUPP):
+			raise
+		shutil.copyfile(src, dst)
+
+def link_duplicates(ops):
+	"""Find operations that would write identical images (same content hash, same tags and codec options), and turn all but the first into "link" operations, where their targets are on the same filesystem
+	Operations without a "digest" are left as they are"""
+	import os
+
+	def device(path):
+		# The target may not exist yet, so find its closest existing parent
+		for par in (path, *path.parents):
+			try:
+				return par.stat().st_dev
+			except FileNotFoundError:
+				continue
+
+	first = {}
+	for n, op in enumerate(ops):
+		if not op.get("digest"):
+			continue
+		target = pathlib.Path(os.path.abspath(op["target"]))
+		key = (op["digest"], device(target), op["action"], json.dumps(op["tags"], sort_keys=True), json.dumps(op["codec"]))
+		if key not in first:
+			first[key] = op
+		elif op["action"] != "tmpcode" and first[key]["target"] != op["target"]:
+			ops[n] = dict(op, action="link", link_from=first[key]["target"])
+	return ops
+
+def shard_spec(spec):
+	"""Parse an "N/M" shard specifier into (N, M), 1 <= N <= M"""
+	import argparse
+	try:
+		num, tot = map(int, spec.split("/", 1))
+	except ValueError:
+		raise argparse.ArgumentTypeError(f"invalid shard {spec!r}, expected N/M")
+	if not 1 <= num <= tot:
+		raise argparse.ArgumentTypeError(f"invalid shard {spec!r}, expected 1 <= N <= M")
+	return (num, tot)
+
+def in_shard(key, shard):
+	"""Test if the album group key belongs to shard (N, M)
+	Uses a stable hash, so independent processes agree on the split"""
+	import zlib
+	num, tot = shard
+	return zlib.crc32(json.dumps(key).encode("utf-8")) % tot == num - 1
 
 if __name__ == "__main__":
 	import argparse
 	import collections
+	import concurrent.futures
 	import configparser
+	import hashlib
+	import mimetypes
 	import os
 	import re
 	import subprocess
@@ -274,20 +806,28 @@ if __name__ == "__main__":
 	parg = argparse.ArgumentParser(description="Unify music files")
 	parg.add_argument("paths", nargs="*", help="where the files to scan are", type=pathlib.Path, default=[])
 	parg.add_argument("-A", "--album-art", help="move albumart to same directory as media files (does not overwrite)", action="store_true")
+	parg.add_argument("-C", "--cleanup", help="remove empty directories left by the sharded operation plan FILE, once all shards have been executed (can be specified multiple times)", metavar="FILE", type=pathlib.Path, action="append", default=[])
 	parg.add_argument("-c", "--config", action="store", default=pathlib.Path("~/.config/bemuse.cfg").expanduser())
 	parg.add_argument("-d", "--dest", help="where to put the files", metavar="DIRECTORY", type=pathlib.Path, action="store", default=os.curdir)
 	parg.add_argument("-D", "--from-file", help="load in media file locations from file (can be specified multiple times)", metavar="FILE", type=pathlib.Path, action="append", default=[])
 	parg.add_argument("-E", "--adjust-metadata", help="apply metadata rules from the config file", action="store_true")
+	parg.add_argument("-g", "--group-by", help="comma-separated tags that identify an album, for album gain and {adisc} (default: album,album_artist)", metavar="KEYS", type=lambda v: tuple(filter(None, map(str.strip, v.split(",")))), default=("album", "album_artist"))
 	parg.add_argument("-G", "--replaygain", help="write ReplayGain tags (requires loudgain tool)", action="store_true")
 	parg.add_argument("-f", "--format", help="a Python-like format string to generate the new path", action="store")
+	parg.add_argument("-j", "--jobs", help="number of operations to run in parallel", metavar="N", type=int, default=1)
 	parg.add_argument("-K", "--remove", help="delete the original file once finished", action="store_true")
 	parg.add_argument("-L", "--list", help="print each file as per the given format and exit", action="store_true")
 	parg.add_argument("-m", "--match", help="only scan files with names that match the given regex", action="store", metavar="REGEX", type=re.compile, default=None)
 	parg.add_argument("-n", "--dry-run", help="print moves, renames, or transcodes without executing them", action="store_true")
 	parg.add_argument("-P", "--preset", help="select a named format string from the config file", action="store")
 	parg.add_argument("-R", "--rename", help="rename or move the files according to the given format (*overwrites files*)", action="store_true")
+	parg.add_argument("-S", "--shard", help="only process album groups belonging to shard N of M", metavar="N/M", type=shard_spec, default=None)
 	parg.add_argument("-T", "--transcode", help="convert files using codec, where options are given in config file (*overwrites files*)", metavar="CODEC", action="store")
 	parg.add_argument("-v", "--verbose", help="increase verbosity level (can be specified multiple times)", action="count")
+	parg.add_argument("-w", "--watch", help="keep running, and process directories again once files in them have stopped changing for SECONDS (default: 5)", metavar="SECONDS", nargs="?", type=float, const=5.0, default=None)
+	parg.add_argument("--gain-store", help="keep per-track loudness data in FILE, so ReplayGain only analyses new or changed tracks", metavar="FILE", type=pathlib.Path, default=None)
+	parg.add_argument("--execute", help="execute an operation plan written by --plan-out, without scanning", metavar="FILE", type=pathlib.Path, default=None)
+	parg.add_argument("--plan-out", help="write the operation plan to FILE instead of executing it", metavar="FILE", type=pathlib.Path, default=None)
 	parg.add_argument("--version", action="version", version="%(prog)s " + __version__)
 	args = parg.parse_args()
 
@@ -302,20 +842,83 @@ if __name__ == "__main__":
 	log = logging.getLogger(str(pathlib.Path(__file__).stem))
 	log.debug("loglevel set to debug")
 
-	if not(any((args.adjust_metadata, args.replaygain, args.list, args.rename, args.transcode, args.album_art))):
+	scan_modes = any((args.adjust_metadata, args.replaygain, args.list, args.rename, args.transcode, args.album_art))
+	if not(scan_modes or args.cleanup or args.execute):
 		log.error("nothing to do: no mode selected")
 		sys.exit(1)
+	if args.execute and (scan_modes or args.plan_out or args.cleanup):
+		log.error("--execute can't be combined with other operational modes")
+		sys.exit(1)
+	if args.cleanup and (scan_modes or args.plan_out):
+		log.error("--cleanup can't be combined with other operational modes")
+		sys.exit(1)
+	if args.shard and not (args.plan_out or args.list or args.dry_run):
+		# A shard writing while another is still scanning could move files out from under it, and change the album groups it sees
+		log.error("--shard needs --plan-out: let every shard finish scanning before --execute'ing any of the plans")
+		sys.exit(1)
+	if args.watch is not None and (args.execute or args.plan_out or args.list or not scan_modes):
+		log.error("--watch needs an operational mode, and can't be combined with --list, --execute or --plan-out")
+		sys.exit(1)
+
+	# Cleanup and executing a plan don't scan anything
+	no_scan = not scan_modes
 
 	formak = strink.Strink()
 
 	class FoundItException(Exception): pass
 
-	def new_path(form, tags, suffix=""):
-		return args.dest / pathlib.Path(formak.vformat(args.format, [], tags) + suffix)
+	def new_paths(form, tracks):
+		"""The new path for each of tracks, or the exception raised while formatting it"""
+		names = formak.format_many(form, (t.tags for t in tracks), return_exceptions=True)
+		# Ensure the correct suffix is used for transcoding
+		return [n if isinstance(n, Exception) else args.dest / pathlib.Path(n + (file_suffix or t.path.suffix)) for t, n in zip(tracks, names)]
 
 	def select_file(path):
 		return (not args.match) or (args.match.search(path) is not None)
 
+	image_probes = {}
+	probe_cache = {}
+	def file_digest(path):
+		"""SHA-256 of a file's contents, as hex"""
+		sha = hashlib.sha256()
+		with open(path, "rb") as fd:
+			for chunk in iter(lambda: fd.read(1 << 20), b""):
+				sha.update(chunk)
+		return sha.hexdigest()
+
+	def probe_path(path):
+		"""Probe.fromPath(), but identical images are only probed once, and unchanged files are only probed once per process"""
+		key = os.path.abspath(path)
+		st = os.stat(path)
+		fingerprint = (st.st_size, st.st_mtime_ns)
+		if key in probe_cache and probe_cache[key][0] == fingerprint:
+			return probe_cache[key][1].clone(path)
+
+		digest = None
+		if (mimetypes.guess_type(path)[0] or "").startswith("image/"):
+			digest = file_digest(path)
+			if digest in image_probes:
+				log.debug(f"{str(path)!r} is identical to {image_probes[digest].filename!r}")
+				meta = image_probes[digest].clone(path)
+				probe_cache[key] = (fingerprint, meta.clone(path))
+				return meta
+
+		meta = Probe.fromPath(path)
+		if meta.is_image():
+			if digest is None:
+				digest = file_digest(path)
+			meta.digest = digest
+			# Keep an unmodified copy, as scan_paths() adds shared metadata to images
+			image_probes.setdefault(digest, meta.clone(path))
+		probe_cache[key] = (fingerprint, meta.clone(path))
+		return meta
+
+	def forget(path):
+		"""Drop the cached probes of a file that has been moved, deleted or rewritten"""
+		cached = probe_cache.pop(os.path.abspath(path), None)
+		if cached and cached[1].digest and cached[1].digest in image_probes and image_probes[cached[1].digest].path == cached[1].path:
+			image_probes.pop(cached[1].digest)
+
 	## TODO: move this to Probe class
 	def scan_paths(paths):
 
@@ -339,8 +942,8 @@ if __name__ == "__main__":
 							subs.append(ent)
 						else:
 							try:
-								meta = Probe.fromPath(ent)
-							except subprocess.CalledProcessError as err:
+								meta = probe_path(ent)
+							except (subprocess.CalledProcessError, OSError) as err:
 								continue
 							if meta is None:
 								continue
@@ -383,8 +986,8 @@ if __name__ == "__main__":
 					yield im
 			else:
 				try:
-					meta = Probe.fromPath(path)
-				except subprocess.CalledProcessError:
+					meta = probe_path(path)
+				except (subprocess.CalledProcessError, OSError):
 					log.error("%r not a media file" % str(path))
 				else:
 					if select_file(meta.path.name):
@@ -393,7 +996,7 @@ if __name__ == "__main__":
 	conf = configparser.ConfigParser(interpolation=None, delimiters="=", inline_comment_prefixes=None)
 	if args.config:
 		conf.read(args.config)
-		if not args.format:
+		if not (args.format or no_scan):
 			if args.preset:
 				preset = args.preset
 			else:
@@ -422,7 +1025,7 @@ if __name__ == "__main__":
 			log.error("codec not specified in config file")
 			sys.exit(1)
 
-	if not (args.format or args.adjust_metadata):
+	if not (args.format or args.adjust_metadata or no_scan):
 		log.error("no formatter specified, don't know what to do")
 		sys.exit(1)
 	
@@ -433,155 +1036,297 @@ if __name__ == "__main__":
 			with lfile.open() as lfd:
 				args.paths.extend(map(pathlib.Path, map(str.strip, lfd.readlines())))
 
+	plan = None
+	if args.execute:
+		with args.execute.open() as pfd:
+			plan = json.load(pfd)
+		if "operations" not in plan:
+			log.error(f"{str(args.execute)!r} is not an operation plan")
+			sys.exit(1)
+		args.paths or args.paths.extend(map(pathlib.Path, plan["paths"]))
+
+	# Directories the sharded plans moved files out of
+	cleanup_dirs = set()
+	cleanup_paths = []
+	for cfile in args.cleanup:
+		with cfile.open() as pfd:
+			cplan = json.load(pfd)
+		if "check_dirs" not in cplan:
+			log.error(f"{str(cfile)!r} is not an operation plan")
+			sys.exit(1)
+		if cplan["remove_empty"]:
+			cleanup_dirs.update(map(pathlib.Path, cplan["check_dirs"]))
+		cleanup_paths.extend(p for p in map(pathlib.Path, cplan["paths"]) if p not in cleanup_paths)
+	args.paths or args.paths.extend(cleanup_paths)
+
 	not (args.paths or args.from_file) and args.paths.append(pathlib.Path(os.curdir))
 	if not args.paths:
 		log.error("no paths to scan")
 		sys.exit(1)
 
-	## Pass 1: collect files and metadata ##
-	album = {}
-	for probe in scan_paths(args.paths):
-		log.debug(f"Probed {probe.filename!r}")
-		if probe.tags:
-			if "album" in probe.tags:
-				album.setdefault(probe.tags["album"], [])
-				album[probe.tags["album"]].append(probe)
-			else:
-				log.warning(f"{probe.filename!r} has no album tag")
-				album.setdefault(None, [])
-				album[None].append(probe)
+	store = args.gain_store and LoudnessStore(args.gain_store)
+
+	def run(paths):
+		"""Scan paths, then plan and execute the selected operations on what was found"""
+		## Pass 1: collect files and metadata ##
+		album = {}
+		for probe in (() if no_scan else scan_paths(paths)):
+			log.debug(f"Probed {probe.filename!r}")
+			if probe.tags:
+				alb = album_key(probe, args.group_by)
+				if alb is None:
+					log.warning(f"{probe.filename!r} has no album tag")
+				album.setdefault(alb, [])
+				album[alb].append(probe)
 
-	## Pass 2: adjust metadata, move (or list) file ##
-	check_dirs = set()
-	for alb in album.keys():
-		tracks = album[alb]
-		rgain = {}
+		if args.shard:
+			for alb in tuple(album.keys()):
+				if not in_shard(alb, args.shard):
+					album.pop(alb)
+			log.info(f"Shard {args.shard[0]}/{args.shard[1]}: {len(album)} album groups")
 
+		## Pass 1b: ReplayGain ##
+		rgains = collections.defaultdict(dict)
 		if args.replaygain and not args.list:
-			log.info(f"Calculating ReplayGain for album {alb!r}")
-			rgain.update(
-				replaygain(filter(lambda t:
-						select_file(t.path.name) and
-						any(c[0] == "audio" for c in t.stream_codecs.values()),
-					tracks)
-				)
-			)
-
-		ndiscs = set()
-		for t in tracks:
-			ndiscs.add(t.tags.get("disc", None))
-		ndiscs.discard(None)
-
-		for t in tracks:
+			work = []
+			for alb, tracks in album.items():
+				gain_tracks = [t for t in tracks if select_file(t.path.name) and any(c[0] == "audio" for c in t.stream_codecs.values())]
+				if not gain_tracks:
+					continue
+				if store:
+					log.info(f"Calculating ReplayGain for album {alb!r}")
+					rgains[alb].update(replaygain_stored(gain_tracks, store, jobs=args.jobs))
+					if alb is None:
+						# Tracks without an album tag only get track gain
+						rgains[alb].pop(None, None)
+					continue
+				# Album gain needs the whole album in one call, so albums are only split by the command line length
+				batches = tuple(replaygain_batches(gain_tracks, size=len(gain_tracks) if alb is not None else 256))
+				if alb is not None and len(batches) == 1:
+					work.append((alb, batches[0], True))
+				else:
+					if alb is not None:
+						log.warning(f"album {alb!r} has too many tracks for one loudgain call, only calculating track gain")
+					work.extend((alb, batch, False) for batch in batches)
+
+			with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+				for (alb, batch, is_album), result in zip(work, pool.map(lambda w: tuple(replaygain(w[1], album=w[2])), work)):
+					log.info(f"Calculated {'album' if is_album else 'track'} ReplayGain for {len(batch)} tracks of album {alb!r}")
+					rgains[alb].update(result)
+
+		## Pass 2: adjust metadata, plan moves (or list) file ##
+		ops = []
+		check_dirs = set()
+		for alb in album.keys():
+			tracks = album[alb]
+			rgain = rgains[alb]
+
+			ndiscs = set()
+			for t in tracks:
+				ndiscs.add(t.tags.get("disc", None))
+			ndiscs.discard(None)
+
 			if len(ndiscs) > 1:
-				if "disc" in t.tags:
-					t.tags["adisc"] = t.tags["disc"]
-				
-			new = {}
-			# log.info(f"File: {t.filename!r}")
+				for t in tracks:
+					if "disc" in t.tags:
+						t.tags["adisc"] = t.tags["disc"]
+
+			news = {t: {} for t in tracks}
 			if args.adjust_metadata:
-				for key, val in conf["Metadata"].items():
-					val = formak.vformat(val, [], t.tags)
-					log.debug(f"  Metadata: {key}={val!r}")
-					t.tags[key] = new[key] = val
-
-			if rgain and args.replaygain and not args.list and t in rgain:
-				new["R128_TRACK_GAIN"] = new["REPLAYGAIN_TRACK_GAIN"] = rgain[t].gain
-				new["R128_ALBUM_GAIN"] = new["REPLAYGAIN_ALBUM_GAIN"] = rgain[None].gain
-				new["R128_TRACK_PEAK"] = new["REPLAYGAIN_TRACK_PEAK"] = rgain[t].true_peak
-				new["R128_ALBUM_PEAK"] = new["REPLAYGAIN_ALBUM_PEAK"] = rgain[None].true_peak
-				new["R128_ALBUM_RANGE"] = new["REPLAYGAIN_ALBUM_RANGE"] = rgain[None].range
-				new["R128_TRACK_RANGE"] = new["REPLAYGAIN_TRACK_RANGE"] = rgain[None].range
-				new["R128_REFERENCE_LOUDNESS"] = new["REPLAYGAIN_REFERENCE_LOUDNESS"] = rgain[None].reference
-			
-			# Ensure the correct suffix is used for transcoding
-			suffix = file_suffix or t.path.suffix
-			try:
-				npath = new_path(args.format, t.tags, suffix)
-			except Exception as e:
-				# TODO: detect and skip albumarts with no tracks in the album
-				log.error(f"could not format new name for {t.filename!r} :: {type(e).__name__} {str(e)}")
-				continue
-			if args.list:
-				print(npath)
-				continue
+				# Each rule only depends on the track's own tags, so format a rule for the whole album at once
+				for key, form in conf["Metadata"].items():
+					for t, val in zip(tracks, formak.format_many(form, (t.tags for t in tracks))):
+						log.debug(f"  Metadata: {t.filename!r} {key}={val!r}")
+						# Don't rewrite a file that already has the right tags
+						if t.tags.get(key, "") != val:
+							news[t][key] = val
+						t.tags[key] = val
 
-			if not args.remove and npath.exists() and npath.samefile(t.path):
-				if args.transcode or new:
-					log.warning(f"will not overwrite {t.filename!r}")
-				continue
+			for t, npath in zip(tracks, new_paths(args.format, tracks)):
+				new = news[t]
 
-			if t.path != npath and ((args.album_art and t.is_image()) or args.rename or args.transcode):
-				if args.dry_run or args.verbose:
-					print(f"{t.filename!r} => {str(npath)!r}")
+				if rgain and args.replaygain and not args.list and t in rgain:
+					gain = {}
+					gain["R128_TRACK_GAIN"] = gain["REPLAYGAIN_TRACK_GAIN"] = rgain[t].gain
+					gain["R128_TRACK_PEAK"] = gain["REPLAYGAIN_TRACK_PEAK"] = rgain[t].true_peak
+					gain["R128_TRACK_RANGE"] = gain["REPLAYGAIN_TRACK_RANGE"] = rgain[t].range
+					gain["R128_REFERENCE_LOUDNESS"] = gain["REPLAYGAIN_REFERENCE_LOUDNESS"] = rgain[t].reference
+					if None in rgain:
+						gain["R128_ALBUM_GAIN"] = gain["REPLAYGAIN_ALBUM_GAIN"] = rgain[None].gain
+						gain["R128_ALBUM_PEAK"] = gain["REPLAYGAIN_ALBUM_PEAK"] = rgain[None].true_peak
+						gain["R128_ALBUM_RANGE"] = gain["REPLAYGAIN_ALBUM_RANGE"] = rgain[None].range
+					# Don't rewrite a file that already has the right tags
+					if all(t.tags.get(k, None) == v for k, v in gain.items()):
+						log.debug(f"  ReplayGain tags unchanged for {t.filename!r}")
+					else:
+						new.update(gain)
 
-			check_dirs.add(t.path.parent)
+				if isinstance(npath, Exception):
+					# TODO: detect and skip albumarts with no tracks in the album
+					log.error(f"could not format new name for {t.filename!r} :: {type(npath).__name__} {str(npath)}")
+					continue
+				if args.list:
+					print(npath)
+					continue
 
-			if args.rename or ((args.adjust_metadata or args.replaygain) and len(new)) or args.transcode or (args.album_art and t.is_image()):
-				target, action = t.writeMeta(new, npath, codec=codec, dryRun = args.dry_run)
-	
-				if action is None:
-					log.debug(f"<no-op {t.filename!r}>")
-				elif action in ("replace", "transcode", "tmpcode"):
-					if action == "replace":
-						log.debug(["mv" if args.remove else "cp", t.filename, str(target)])
-					if not args.dry_run:
-						if args.remove:
-							if not (npath.exists() and target.samefile(npath)):
-								log.debug(["mv", str(target), str(npath)])
-								target.replace(npath)
-							else:
-								log.debug(["rm", str(t.path)])
-								t.path.unlink()
-						elif not (npath.exists() and npath.samefile(t.path)):
-							npath.write_bytes(target.read_bytes())
-							if action == "tmpcode":
-								target.unlink()
-						t.path = npath
-
-	## Pass 3: album art ##
-	#if args.album_art:
-	#	cpimg = set()
-	#	for p, imgs in imgpaths.items():
-	#		for i in imgs:
-	#			nimg = p / i.path.name
-	#			if nimg.exists() or nimg == i.path:
-	#				log.debug(f"not overwriting {nimg}")
-	#				continue
-	#			(args.dry_run or args.verbose) and print(f"{str(i.path)!r} => {str(nimg)!r}")
-	#			args.dry_run or nimg.write_bytes(i.path.read_bytes())
-	#			cpimg.add(i)
-	#	for i in cpimg:
-	#		(args.dry_run or args.verbose) and log.debug(f"rm {str(i.path)!r}")
-	#		args.dry_run or i.path.unlink()
+				if not args.remove and npath.exists() and npath.samefile(t.path):
+					if args.transcode or new:
+						log.warning(f"will not overwrite {t.filename!r}")
+					continue
+
+				if t.path != npath and ((args.album_art and t.is_image()) or args.rename or args.transcode):
+					if args.dry_run or args.verbose:
+						print(f"{t.filename!r} => {str(npath)!r}")
+
+				check_dirs.add(t.path.parent)
+
+				if args.rename or ((args.adjust_metadata or args.replaygain) and len(new)) or args.transcode or (args.album_art and t.is_image()):
+					op = t.planMeta(new, npath, codec=codec, remove=args.remove)
+					if op is None:
+						log.debug(f"<no-op {t.filename!r}>")
+					else:
+						if t.digest:
+							op["digest"] = t.digest
+						ops.append(op)
+
+		# Write identical images once, and link the rest
+		link_duplicates(ops)
+
+		remove_empty = bool((args.transcode or args.rename) and args.remove)
+		if plan is not None:
+			ops = plan["operations"]
+			remove_empty = plan["remove_empty"]
+			check_dirs.update(map(pathlib.Path, plan["check_dirs"]))
+
+		if args.plan_out:
+			with args.plan_out.open("w") as pfd:
+				json.dump({
+					"bemuse": __version__,
+					"paths": [os.path.abspath(p) for p in paths],
+					"shard": args.shard,
+					"remove_empty": remove_empty,
+					"check_dirs": sorted(os.path.abspath(d) for d in check_dirs),
+					"operations": [dict(op, source=os.path.abspath(op["source"]), target=os.path.abspath(op["target"])) for op in ops],
+				}, pfd, indent="\t")
+			log.info(f"Wrote {len(ops)} operations to {str(args.plan_out)!r}")
+			remove_empty = False
+			check_dirs.clear()
+		else:
+			def done(op):
+				store and store.moved(op)
+				if op["remove"] or op["action"] == "tmpcode":
+					forget(op["source"])
+
+			if execute_plan(ops, jobs=args.jobs, dryRun=args.dry_run, done=done):
+				log.warning("some operations failed")
+
+		if store and not args.dry_run:
+			store.save()
+
+		log.debug("Strink cache hits: " + ", ".join(f"{kind} {hits}/{hits + misses} ({100 * hits / (hits + misses or 1):.0f}%)" for kind, (hits, misses, size) in formak.cache_info().items()))
+
+		## Pass 3: album art ##
+		#if args.album_art:
+		#	cpimg = set()
+		#	for p, imgs in imgpaths.items():
+		#		for i in imgs:
+		#			nimg = p / i.path.name
+		#			if nimg.exists() or nimg == i.path:
+		#				log.debug(f"not overwriting {nimg}")
+		#				continue
+		#			(args.dry_run or args.verbose) and print(f"{str(i.path)!r} => {str(nimg)!r}")
+		#			args.dry_run or nimg.write_bytes(i.path.read_bytes())
+		#			cpimg.add(i)
+		#	for i in cpimg:
+		#		(args.dry_run or args.verbose) and log.debug(f"rm {str(i.path)!r}")
+		#		args.dry_run or i.path.unlink()
 	
-	## Pass 4: check_dirs ##
-	if (args.transcode or args.rename) and args.remove:
-		args.dry_run and log.info("Dry run selected: empty directories won't be found")
-		errored = set()
-		alldirs = set()
-		for d in reversed(sorted(check_dirs, key=lambda p:len(str(p)))):
-			log.debug(f"Checking {str(d)!r}")
-			d = d / "file"
-			for par in d.parents:
-				if par.samefile("."):
+		## Pass 4: check_dirs ##
+		if args.cleanup:
+			check_dirs.update(cleanup_dirs)
+		elif (args.shard or plan is not None and plan.get("shard")) and remove_empty:
+			log.info("Shard selected: leaving empty directories for --cleanup")
+			check_dirs.clear()
+
+		if check_dirs and (remove_empty or args.cleanup):
+			args.dry_run and log.info("Dry run selected: empty directories won't be found")
+			errored = set()
+			alldirs = set()
+			for d in reversed(sorted(check_dirs, key=lambda p:len(str(p)))):
+				log.debug(f"Checking {str(d)!r}")
+				d = d / "file"
+				for par in d.parents:
+					if par.samefile(".") or (args.watch is not None and par in args.paths):
+						continue
+					for spec in paths:
+						if par.is_relative_to(spec):
+							alldirs.add(par)
+							break
+
+			for d in reversed(sorted(alldirs, key=lambda p:len(str(p)))):
+				try:
+					for e in errored:
+						if e.is_relative_to(d):
+							raise FoundItException
+				except FoundItException:
 					continue
-				for spec in args.paths:
-					if par.is_relative_to(spec):
-						alldirs.add(par)
-						break
 
-		for d in reversed(sorted(alldirs, key=lambda p:len(str(p)))):
-			try:
-				for e in errored:
-					if e.is_relative_to(d):
-						raise FoundItException
-			except FoundItException:
-				continue
+				try:
+					args.verbose and print(f"rmdir {str(d)!r}")
+					args.dry_run or d.rmdir()
+				except OSError:
+					args.dry_run and log.warning(f"{str(d)!r} not empty")
+					errored.add(d)
 
-			try:
-				args.verbose and print(f"rmdir {str(d)!r}")
-				args.dry_run or d.rmdir()
-			except OSError:
-				args.dry_run and log.warning(f"{str(d)!r} not empty")
-				errored.add(d)
+	def album_dirs(dirs):
+		"""The directories to scan after changes in dirs: the dirs themselves, plus any others holding tracks of the same albums"""
+		dirs = {d for d in dirs if d.is_dir()}
+		keys = {album_key(p, args.group_by) for p in scan_paths(sorted(dirs))} - {None}
+		for fingerprint, meta in tuple(probe_cache.values()):
+			if not meta.path.exists():
+				# Deleted or moved outside of bemuse.py
+				forget(meta.path)
+			elif album_key(meta, args.group_by) in keys:
+				dirs.add(meta.path.parent)
+		# Directories inside others are scanned anyway
+		return sorted(d for d in dirs if not any(d != o and d.is_relative_to(o) for o in dirs))
+
+	if args.watch is None:
+		run(args.paths)
+	else:
+		import time
+
+		watcher = Inotify()
+		for spec in args.paths:
+			spec.is_dir() and watcher.add(spec)
+		run(args.paths)
+
+		# Directories with changes, and when they last changed
+		pending = {}
+		log.info("Watching for changes")
+		try:
+			while True:
+				# Directories with files still being written wait for them to be closed
+				settling = [t for d, t in pending.items() if not any(w.is_relative_to(d) for w in watcher.writing)]
+				wait = max(0.0, min(settling) + args.watch - time.monotonic()) if settling else None
+				for path in watcher.read(wait):
+					pending[path if path.is_dir() else path.parent] = time.monotonic()
+
+				now = time.monotonic()
+				ready = {d for d, t in pending.items() if now - t >= args.watch and not any(w.is_relative_to(d) for w in watcher.writing)}
+				for d in ready:
+					pending.pop(d)
+				if ready:
+					dirs = album_dirs(ready)
+					if not dirs:
+						continue
+					log.info("Changes in " + ", ".join(repr(str(d)) for d in dirs))
+					try:
+						run(dirs)
+					except Exception as err:
+						# Keep watching; the same files are tried again when they next change
+						log.error(f"could not process changes :: {type(err).__name__} {str(err)}")
+		except KeyboardInterrupt:
+			pass
+		finally:
+			watcher.close()
@@ -11,6 +11,13 @@ import unicodedata
 
 _DEBUG = False
 
+_IDENT = r"(?:[a-zA-Z_][a-zA-Z0-9_]*)"
+# {{, }} and ## are always literal. {. and .} are always syntactical. Tokenise { and } last
+_TOKENS = re.compile(r"({{|}}|##|{\.|\.}|[{}])")
+#                      field        conv              spec      cond
+_FIELD = re.compile(f"({_IDENT})(?:!([a-zA-Z]))?(?::([^\\?]+))?(\\?.*)?")
+_FORMSPEC = re.compile(r"^(?:(.(?=[<>=^]))?([<>=^])?)?([+\- ])?(#)?(0)?(\d+)?([_,])?(\.\d+)?([bcdeEfFgGnosxX%])?$")
+
 def unaccent(text):
 	"""Translate accented characters to their non-accented equivalents"""
 	@functools.cache
@@ -62,7 +69,19 @@ class Strink(string.Formatter):
 			Otherwise, 00 will be substituted
 		{composer!u?{composer}#{artist}}
 			If {composer} is present and set, then sub in unaccent({composer})
-			Otherwise, sub in unaccent({artist})"""
+			Otherwise, sub in unaccent({artist})
+
+	Parsed format strings, formatted fields and evaluated conditionals are remembered in LRU caches of up to cache_size entries each,
+	so formatting the same values again (e.g. {album!w} for every track of an album) is cheap. See cache_info()"""
+
+	_Missing = object()
+
+	def __init__(self, cache_size=4096):
+		super().__init__()
+		self.cache_size = cache_size
+		self._caches = {kind: collections.OrderedDict() for kind in ("parse", "field", "conditional")}
+		self._hits = collections.Counter()
+		self._misses = collections.Counter()
 
 	class Conditional:
 		def __init__(self, test, /):
@@ -77,6 +96,18 @@ class Strink(string.Formatter):
 		def isdigit(self):
 			return False
 
+		def fields(self):
+			"""Names of all the fields this conditional depends on, including nested conditionals"""
+			if not hasattr(self, "_fields"):
+				names = {self.test}
+				for lit, field, spec, conv in self.thenClause + self.elseClause:
+					if isinstance(field, type(self)):
+						names.update(field.fields())
+					elif field and not field.isdigit():
+						names.add(field)
+				self._fields = tuple(sorted(names))
+			return self._fields
+
 		def addClause(self, what):
 			if self.clause == "then":
 				self.thenClause.append(what)
@@ -107,7 +138,7 @@ class Strink(string.Formatter):
 
 		if not formspec:
 			return str(val)
-		r = re.match("^(?:(.(?=[<>=^]))?([<>=^])?)?([+\- ])?(#)?(0)?(\d+)?([_,])?(\.\d+)?([bcdeEfFgGnosxX%])?$", formspec)
+		r = _FORMSPEC.match(formspec)
 		if not r:
 			raise ValueError(f"invalid format specifier {formspec!r}")
 		
@@ -117,32 +148,97 @@ class Strink(string.Formatter):
 
 		return super().format_field(val, "".join(filter(bool, (fill, align, sign, alt, zf, width, group, prec, vtype))))
 	
+	def _cached(self, kind, key, compute):
+		cache = self._caches[kind]
+		try:
+			val = cache[key]
+		except KeyError:
+			pass
+		except TypeError:
+			# Unhashable value, can't be cached
+			return compute()
+		else:
+			cache.move_to_end(key)
+			self._hits[kind] += 1
+			return val
+		self._misses[kind] += 1
+		val = cache[key] = compute()
+		if len(cache) > self.cache_size:
+			cache.popitem(last=False)
+		return val
+
+	def cache_info(self):
+		"""{kind: (hits, misses, current size)} for each cache ("parse", "field" and "conditional")"""
+		return {kind: (self._hits[kind], self._misses[kind], len(cache)) for kind, cache in self._caches.items()}
+
+	def cache_clear(self):
+		for cache in self._caches.values():
+			cache.clear()
+		self._hits.clear()
+		self._misses.clear()
+
+	def evaluate(self, field, conv, spec, args, kwargs):
+		"""Look up, convert and format a single parsed field"""
+		val = self.get_field(field, args, kwargs)[0]
+		# 1 == True == 1.0, but they don't format the same
+		return self._cached("field", (type(val), val, conv, spec), lambda: self.format_field(self.convert_field(val, conv), spec))
+
+	def vformat(self, form, args, kwargs):
+		return "".join( (lit + self.evaluate(field, conv, spec, args, kwargs) for lit, field, spec, conv in self.parse(form)) )
+
+	def format_many(self, form, mappings, return_exceptions=False):
+		"""Format form with each of mappings, only parsing it once
+		Returns a list of strings. If return_exceptions is True, then an exception raised while formatting is put in the list in place of its string"""
+		mappings = list(mappings)
+		try:
+			toks = self.parse(form)
+		except Exception as err:
+			if not return_exceptions:
+				raise
+			return [err] * len(mappings)
+
+		results = []
+		for kwargs in mappings:
+			try:
+				results.append("".join( (lit + self.evaluate(field, conv, spec, (), kwargs) for lit, field, spec, conv in toks) ))
+			except Exception as err:
+				if not return_exceptions:
+					raise
+				results.append(err)
+		return results
+
 	def get_field(self, fieldDesc, args, kwargs):
 		if fieldDesc.isdigit() or fieldDesc == "":
 			return ("", None)
 		if isinstance(fieldDesc, type(self).Conditional):
-			if fieldDesc.test in kwargs:
-				toks = fieldDesc.thenClause
-				# Special case for {foo?} to return {foo} (if it is present)
-				if not len(toks):
-					return (kwargs[fieldDesc.test], fieldDesc)
-			else:
-				toks = fieldDesc.elseClause
-				if not len(toks) and not len(fieldDesc.thenClause):
-					return (None, fieldDesc)
-			return ("".join( (lit + self.format_field(self.convert_field(self.get_field(field, args, kwargs)[0], conv), spec) for lit, field, spec, conv in toks) ), fieldDesc)
+			# The result only depends on the values of the fields the conditional uses
+			key = (fieldDesc, tuple( (kwargs[f] if f in kwargs else self._Missing) for f in fieldDesc.fields() ))
+			return self._cached("conditional", key, lambda: self._get_conditional(fieldDesc, args, kwargs))
 		else:
 			return super().get_field(fieldDesc, args, kwargs)
 
+	def _get_conditional(self, fieldDesc, args, kwargs):
+		if fieldDesc.test in kwargs:
+			toks = fieldDesc.thenClause
+			# Special case for {foo?} to return {foo} (if it is present)
+			if not len(toks):
+				return (kwargs[fieldDesc.test], fieldDesc)
+		else:
+			toks = fieldDesc.elseClause
+			if not len(toks) and not len(fieldDesc.thenClause):
+				return (None, fieldDesc)
+		return ("".join( (lit + self.evaluate(field, conv, spec, args, kwargs) for lit, field, spec, conv in toks) ), fieldDesc)
+
 	def parse(self, form):
+		"""Cached tokenise(), as a tuple"""
+		return self._cached("parse", form, lambda: tuple(self.tokenise(form)))
+
+	def tokenise(self, form):
 		_DEBUG and print(f"START PARSE: {form!r}")
 		# if form == "":
 		#	yield ("", "", "", None)
 
-		ident = r"(?:[a-zA-Z_][a-zA-Z0-9_]*)"
-		# {{, }} and ## are always literal. {. and .} are always syntactical. Tokenise { and } last
-		tokrx = r"({{|}}|##|{\.|\.}|[{}])"
-		tokiter = collections.deque(filter(bool, re.split(tokrx, form)))
+		tokiter = collections.deque(filter(bool, _TOKENS.split(form)))
 		lit = field = spec = conv = None
 		stack = []
 
@@ -159,8 +255,7 @@ class Strink(string.Formatter):
 				if tok in ("}", ".}"):
 					continue
 				_DEBUG and print (f"after {{ TOK : {tok!r}")
-				#                  field        conv              spec      cond
-				fldrx = re.split(f"({ident})(?:!([a-zA-Z]))?(?::([^\?]+))?(\?.*)?", tok, 1)
+				fldrx = _FIELD.split(tok, 1)
 				_DEBUG and print ("REGEX: [%s]" % ",".join(map(repr, fldrx )))
 				if len(fldrx) == 1:
 					raise StrinkIdentError(tok)